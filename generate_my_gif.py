@@ -16,37 +16,50 @@ Mask format:
 """
 
 import os
-import glob
 from multiclass_segmentation_gif import create_multiclass_segmentation_gif
 
 
-def match_images_and_masks(image_dir, mask_dir):
+def match_images_and_masks(image_dir, mask_dir, verbose=False):
     """
     Match images with their corresponding masks based on filename.
     
+    Prints a single summary line; with verbose=True, also lists the images
+    that have no mask.
+    
     Returns:
         Tuple of (image_paths, mask_paths) with matching pairs
     """
-    # Get all image files
-    image_files = sorted(glob.glob(os.path.join(image_dir, "*.png")))
+    # Scan each directory once; DirEntry carries the name and full path
+    with os.scandir(mask_dir) as entries:
+        mask_names = {entry.name for entry in entries if entry.is_file()}
+    
+    with os.scandir(image_dir) as entries:
+        image_files = sorted(
+            (
+                entry for entry in entries
+                if entry.is_file()
+                and entry.name.endswith(".png")
+                and not entry.name.startswith(".")
+            ),
+            key=lambda entry: entry.name
+        )
     
     # Find matching masks
     matched_images = []
     matched_masks = []
+    missing = []
     
-    for img_path in image_files:
-        # Extract filename without directory
-        img_filename = os.path.basename(img_path)
-        
-        # Look for corresponding mask
-        mask_path = os.path.join(mask_dir, img_filename)
-        
-        if os.path.exists(mask_path):
-            matched_images.append(img_path)
-            matched_masks.append(mask_path)
-            print(f"Matched: {img_filename}")
+    for entry in image_files:
+        if entry.name in mask_names:
+            matched_images.append(entry.path)
+            matched_masks.append(os.path.join(mask_dir, entry.name))
         else:
-            print(f"No mask found for: {img_filename}")
+            missing.append(entry.name)
+    
+    print(f"Matched {len(matched_images)}/{len(image_files)} pairs; {len(missing)} missing")
+    if verbose:
+        for name in missing:
+            print(f"No mask found for: {name}")
     
     return matched_images, matched_masks
 
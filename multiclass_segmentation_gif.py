@@ -8,8 +8,71 @@ Designed for axon and myelin segmentation visualization.
 
 import numpy as np
 from PIL import Image
-from typing import List, Union, Tuple, Optional, Dict
+from typing import Any, Callable, Iterator, List, Union, Tuple, Optional, Dict
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import io
+import multiprocessing
 import os
+import threading
+
+try:
+    import numba
+except ImportError:  # Optional: overlay falls back to the NumPy blend
+    numba = None
+
+try:
+    import cv2
+except ImportError:  # Optional: frames and masks are resized through PIL
+    cv2 = None
+
+try:
+    import simd_blend_modes as sbm
+except ImportError:  # Optional: overlay falls back to the NumPy blend
+    sbm = None
+
+# Loader threads and pairs decoded ahead of the serial frame loop
+_PREFETCH_WORKERS = 4
+_PREFETCH_WINDOW = 8
+
+# Animated formats accepted by generate_gif
+_OUTPUT_FORMATS = ('gif', 'webp')
+
+# Mask values within this distance of a class value belong to that class
+# (match_mode='tolerance'); 'exact' only maps the class value itself
+_CLASS_TOLERANCE = 10
+_MATCH_MODES = ('tolerance', 'exact')
+
+
+def _as_uint8_mask(mask: Union[np.ndarray, Image.Image]) -> np.ndarray:
+    """Convert a mask to contiguous uint8, mapping out-of-range values to 0."""
+    mask = np.asarray(mask)
+    if mask.dtype != np.uint8:
+        # Values outside 0..255 (e.g. a -1 "ignore" label) are background,
+        # not wrapped around onto a class value
+        mask = np.where((mask >= 0) & (mask <= 255), mask, 0)
+    return np.ascontiguousarray(mask, dtype=np.uint8)
+
+
+if numba is not None:
+    @numba.njit(parallel=True, cache=True)
+    def _blend_overlay_numba(img, mask, class_lut, class_rgb, alpha_u8, out):
+        """Classify and blend every pixel in one pass over the mask."""
+        height, width = mask.shape
+        inv_alpha = 255 - alpha_u8
+        for y in numba.prange(height):
+            for x in range(width):
+                class_id = class_lut[mask[y, x]]
+                if class_id == 0:
+                    for c in range(3):
+                        out[y, x, c] = img[y, x, c]
+                else:
+                    for c in range(3):
+                        out[y, x, c] = (
+                            img[y, x, c] * inv_alpha
+                            + class_rgb[class_id, c] * alpha_u8
+                            + 127
+                        ) // 255
 
 
 class MultiClassSegmentationGifGenerator:
@@ -21,7 +84,8 @@ class MultiClassSegmentationGifGenerator:
         mask_duration: int = 1000,
         class_colors: Optional[Dict[int, Tuple[int, int, int]]] = None,
         mask_alpha: float = 0.5,
-        loop: int = 0
+        loop: int = 0,
+        match_mode: str = 'tolerance'
     ):
         """
         Args:
@@ -30,11 +94,18 @@ class MultiClassSegmentationGifGenerator:
             class_colors: Dict mapping pixel values to RGB colors
             mask_alpha: Overlay transparency (0.0 to 1.0)
             loop: Loop count (0 = infinite)
+            match_mode: 'tolerance' (class value +/- 10) or 'exact'
         """
+        if match_mode not in _MATCH_MODES:
+            raise ValueError(
+                f"match_mode must be one of {_MATCH_MODES}, got {match_mode!r}"
+            )
+        
         self.image_duration = image_duration
         self.mask_duration = mask_duration
         self.mask_alpha = mask_alpha
         self.loop = loop
+        self.match_mode = match_mode
         
         # Default color mapping: white->blue, gray->red
         if class_colors is None:
@@ -44,39 +115,140 @@ class MultiClassSegmentationGifGenerator:
             }
         else:
             self.class_colors = class_colors
+        
+        # Class-id lookup table indexed by mask value (0 = background) and
+        # the matching color table, built once per generator. Later classes
+        # override earlier ones where tolerance ranges overlap. Both match
+        # modes share this table, so per-frame work is the same gather.
+        tolerance = _CLASS_TOLERANCE if match_mode == 'tolerance' else 0
+        self._alpha_u8 = int(self.mask_alpha * 255)
+        self._class_lut = np.zeros(256, dtype=np.uint8)
+        self._class_rgb = np.zeros((len(self.class_colors) + 1, 3), dtype=np.uint16)
+        for class_id, (pixel_value, color) in enumerate(self.class_colors.items(), start=1):
+            lo = max(0, pixel_value - tolerance)
+            hi = min(255, pixel_value + tolerance)
+            self._class_lut[lo:hi + 1] = class_id
+            self._class_rgb[class_id] = color
+        
+        # Per-mask-value blend weight and premultiplied color (+127 for
+        # rounding) for the NumPy path. Background keeps weight 255 and
+        # offset 127, so (img * 255 + 127) // 255 leaves it unchanged.
+        is_class = self._class_lut != 0
+        self._inv_alpha_lut = np.where(is_class, 255 - self._alpha_u8, 255).astype(np.uint16)
+        self._premul_lut = (
+            self._class_rgb[self._class_lut] * self._alpha_u8 + 127
+        ).astype(np.uint16)
+        
+        # RGBA overlay color per mask value for the simd_blend_modes path
+        if sbm is not None:
+            self._overlay_lut = np.zeros((256, 4), dtype=np.uint8)
+            self._overlay_lut[:, :3] = self._class_rgb[self._class_lut]
+            self._overlay_lut[:, 3] = np.where(self._class_lut != 0, self._alpha_u8, 0)
+        
+        # Per-frame intermediates, reused while the frame size is unchanged.
+        # Kept per thread so concurrent overlay calls don't share buffers.
+        self._scratch = threading.local()
+    
+    def __getstate__(self) -> Dict[str, Any]:
+        # Scratch buffers are per process; don't ship them to workers
+        state = self.__dict__.copy()
+        del state['_scratch']
+        return state
+    
+    def __setstate__(self, state: Dict[str, Any]):
+        self.__dict__.update(state)
+        self._scratch = threading.local()
+    
+    def _scratch_buffer(
+        self,
+        name: str,
+        shape: Tuple[int, ...],
+        dtype: type = np.uint8
+    ) -> np.ndarray:
+        """Return this thread's scratch buffer `name`, reallocating on shape/dtype change."""
+        buffers = vars(self._scratch)
+        buffer = buffers.get(name)
+        if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+            buffer = buffers[name] = np.empty(shape, dtype=dtype)
+        return buffer
     
     def create_multiclass_overlay(
         self,
-        image: Image.Image,
-        mask: np.ndarray
-    ) -> Image.Image:
+        image: Union[np.ndarray, Image.Image],
+        mask: np.ndarray,
+        out: Optional[np.ndarray] = None
+    ) -> np.ndarray:
         """
         Create an image with multi-class mask overlay.
         
+        The image is treated as opaque: any alpha channel (RGBA/LA/PA
+        sources) is dropped before blending, so partially transparent
+        pixels are blended from their color alone rather than composited
+        with their alpha.
+        
+        Intermediate buffers are reused per thread, so concurrent calls on
+        one generator are safe.
+        
         Args:
-            image: PIL Image object
+            image: RGB uint8 array (HxWx3) or PIL Image
             mask: 2D grayscale mask (HxW)
+            out: Optional RGB uint8 array (HxWx3) to write the result into
         
         Returns:
-            PIL Image with colored mask overlay
+            RGB uint8 array (HxWx3) with colored mask overlay
         """
-        image = image.convert('RGBA')
-        overlay = Image.new('RGBA', image.size, (0, 0, 0, 0))
-        overlay_array = np.array(overlay)
-        
-        # Convert to int16 to avoid uint8 underflow
-        mask = mask.astype(np.int16)
-        alpha_value = int(self.mask_alpha * 255)
-        
-        # Apply colors for each class
-        for pixel_value, color in self.class_colors.items():
-            class_mask = np.abs(mask - pixel_value) <= 10
-            if np.any(class_mask):
-                overlay_array[class_mask] = (*color, alpha_value)
-        
-        overlay = Image.fromarray(overlay_array, 'RGBA')
-        result = Image.alpha_composite(image, overlay)
-        return result.convert('RGB')
+        if isinstance(image, Image.Image):
+            img = np.asarray(image.convert('RGB'))
+        else:
+            img = image
+        mask = _as_uint8_mask(mask)
+        
+        # The blend backends index by mask shape without bounds checks
+        if img.ndim != 3 or img.shape[2] != 3:
+            raise ValueError(f"Image must be HxWx3 RGB, got shape {img.shape}")
+        if mask.shape != img.shape[:2]:
+            raise ValueError(
+                f"Mask shape {mask.shape} does not match image shape {img.shape[:2]}"
+            )
+        if out is None:
+            out = np.empty_like(img)
+        elif out.shape != img.shape or out.dtype != np.uint8:
+            raise ValueError(
+                f"out must be a uint8 array of shape {img.shape}, "
+                f"got {out.dtype} array of shape {out.shape}"
+            )
+        height, width = mask.shape
+        
+        if numba is not None:
+            _blend_overlay_numba(
+                img, mask, self._class_lut, self._class_rgb, self._alpha_u8, out
+            )
+            return out
+        
+        if sbm is not None:
+            img_rgba = self._scratch_buffer('image_rgba', (height, width, 4))
+            img_rgba[..., :3] = img
+            img_rgba[..., 3] = 255
+            overlay_rgba = self._scratch_buffer('overlay_rgba', (height * width, 4))
+            self._overlay_lut.take(mask.ravel(), axis=0, out=overlay_rgba)
+            blended = sbm.normal(img_rgba, overlay_rgba.reshape(height, width, 4), 1.0)
+            np.copyto(out, blended[..., :3])
+            return out
+        
+        # Constant-alpha "over" blend in fixed point, rounded like PIL,
+        # done in place over the whole frame with per-mask-value tables
+        flat_mask = mask.ravel()
+        blend = self._scratch_buffer('blend', (height, width, 3), np.uint16)
+        np.copyto(blend, img)
+        inv_alpha = self._scratch_buffer('inv_alpha', (height * width,), np.uint16)
+        self._inv_alpha_lut.take(flat_mask, out=inv_alpha)
+        blend *= inv_alpha.reshape(height, width, 1)
+        premul = self._scratch_buffer('premul', (height * width, 3), np.uint16)
+        self._premul_lut.take(flat_mask, axis=0, out=premul)
+        blend += premul.reshape(height, width, 3)
+        blend //= 255
+        np.copyto(out, blend, casting='unsafe')
+        return out
     
     def load_image(self, image_path: Union[str, Image.Image]) -> Image.Image:
         """Load image from path or return if already PIL Image."""
@@ -84,20 +256,114 @@ class MultiClassSegmentationGifGenerator:
             return image_path
         return Image.open(image_path)
     
-    def load_mask(self, mask_path: Union[str, np.ndarray]) -> np.ndarray:
-        """Load 2D mask from path or return if already numpy array."""
-        if isinstance(mask_path, np.ndarray):
+    def load_mask(
+        self,
+        mask_path: Union[str, np.ndarray, Image.Image]
+    ) -> Union[np.ndarray, Image.Image]:
+        """
+        Load 2D mask from path or return if already array/PIL Image.
+        
+        Paths are decoded eagerly and returned as PIL Images so a resize can
+        run before the single conversion to ndarray. Arrays come back as
+        contiguous uint8.
+        """
+        if isinstance(mask_path, Image.Image):
             return mask_path
-        return np.array(Image.open(mask_path))
+        if isinstance(mask_path, np.ndarray):
+            return _as_uint8_mask(mask_path)
+        mask_img = Image.open(mask_path)
+        mask_img.load()
+        return mask_img
+    
+    def _iter_processed_pairs(
+        self,
+        images: List[Union[str, Image.Image]],
+        masks: List[Union[str, np.ndarray, Image.Image]],
+        resize: Optional[Tuple[int, int]],
+        max_workers: Optional[int]
+    ) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        """Yield (image, overlay) RGB arrays for each pair, in input order."""
+        if max_workers == 1:
+            # Decode upcoming pairs on I/O threads while the current one is
+            # resized and blended
+            with ThreadPoolExecutor(max_workers=_PREFETCH_WORKERS) as loader:
+                pending = deque()
+                for img_path, mask_path in zip(images, masks):
+                    pending.append((
+                        loader.submit(_load_decoded, self.load_image, img_path),
+                        loader.submit(_load_decoded, self.load_mask, mask_path)
+                    ))
+                    if len(pending) < _PREFETCH_WINDOW:
+                        continue
+                    image_future, mask_future = pending.popleft()
+                    yield _process_pair(
+                        self, image_future.result(), mask_future.result(), resize
+                    )
+                
+                while pending:
+                    image_future, mask_future = pending.popleft()
+                    yield _process_pair(
+                        self, image_future.result(), mask_future.result(), resize
+                    )
+            return
+        
+        # Keep a bounded window of pairs in flight so finished frames don't
+        # pile up in memory while the encoder catches up
+        window = 2 * (max_workers or os.cpu_count() or 1)
+        # Spawn on every platform and Python version: workers start clean
+        # (no forked Numba/OpenCV thread pools) and behave the same everywhere
+        with ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_worker
+        ) as executor:
+            pending = deque()
+            for img_path, mask_path in zip(images, masks):
+                pending.append(
+                    executor.submit(_process_pair, self, img_path, mask_path, resize)
+                )
+                if len(pending) < window:
+                    continue
+                yield pending.popleft().result()
+            
+            while pending:
+                yield pending.popleft().result()
     
     def generate_gif(
         self,
         images: List[Union[str, Image.Image]],
         masks: List[Union[str, np.ndarray, Image.Image]],
         output_path: str,
-        resize: Optional[Tuple[int, int]] = None
+        resize: Optional[Tuple[int, int]] = None,
+        max_workers: Optional[int] = 1,
+        output_format: str = 'gif',
+        buffer_output: bool = True,
+        shared_palette: bool = False
     ):
-        """Generate segmentation GIF from images and masks."""
+        """
+        Generate segmentation GIF from images and masks.
+        
+        Pairs are processed serially by default. For long sequences of large
+        frames, pass max_workers > 1 (or None for the CPU count) to produce
+        frames in parallel worker processes; encoding stays on the calling
+        process.
+        Pass output_format='webp' for an animated WebP instead; note that
+        Pillow's WebP writer holds all frames in memory as RGB, so prefer
+        GIF for long sequences of large frames. With
+        shared_palette=True, GIF frames are quantized against one palette
+        built from the first pair, which is faster to encode but only
+        accurate when all frames look alike; by default each frame gets
+        its own adaptive palette.
+        
+        The encoded file is built in memory and written in one call; pass
+        buffer_output=False to stream it to disk for outputs too large
+        for RAM.
+        """
+        if output_format not in _OUTPUT_FORMATS:
+            raise ValueError(
+                f"output_format must be one of {_OUTPUT_FORMATS}, got {output_format!r}"
+            )
+        
         if len(images) != len(masks):
             raise ValueError(
                 f"Number of images ({len(images)}) must match number of masks ({len(masks)})"
@@ -106,71 +372,150 @@ class MultiClassSegmentationGifGenerator:
         if len(images) == 0:
             raise ValueError("At least one image-mask pair is required")
         
-        frames = []
-        durations = []
+        # Two frames per pair: image alone, then with the mask overlay
+        durations = [self.image_duration, self.mask_duration] * len(images)
         
         print(f"Generating multi-class segmentation GIF with {len(images)} image-mask pairs...")
         print(f"Class color mapping: {self.class_colors}")
         
-        for i, (img_path, mask_path) in enumerate(zip(images, masks)):
-            print(f"Processing pair {i+1}/{len(images)}...")
-            
-            # Load image and mask
-            image = self.load_image(img_path)
-            mask = self.load_mask(mask_path)
-            
-            # Resize if specified
-            if resize is not None:
-                image = image.resize(resize, Image.Resampling.LANCZOS)
-                mask_img = Image.fromarray(mask.astype(np.uint8))
-                mask_img = mask_img.resize(resize, Image.Resampling.NEAREST)
-                mask = np.array(mask_img)
-            
-            # Convert to RGB for GIF
-            image_rgb = image.convert('RGB')
-            
-            # Create frame with just the image
-            frames.append(image_rgb)
-            durations.append(self.image_duration)
-            
-            # Create frame with mask overlay
-            overlaid = self.create_multiclass_overlay(image, mask)
-            frames.append(overlaid)
-            durations.append(self.mask_duration)
-        
-        # Save as GIF
-        print(f"Saving GIF to {output_path}...")
-        frames[0].save(
-            output_path,
-            save_all=True,
-            append_images=frames[1:],
-            duration=durations,
-            loop=self.loop,
-            optimize=False
-        )
+        def _iter_frames() -> Iterator[Image.Image]:
+            palette_image = None
+            pairs = self._iter_processed_pairs(images, masks, resize, max_workers)
+            for i, (image_rgb, overlaid) in enumerate(pairs):
+                print(f"Processing pair {i+1}/{len(images)}...")
+                pair_frames = (
+                    Image.fromarray(image_rgb, 'RGB'),
+                    Image.fromarray(overlaid, 'RGB')
+                )
+                
+                if output_format == 'gif' and shared_palette:
+                    # Quantize every frame against one palette instead of
+                    # letting the encoder build an adaptive one per frame
+                    if palette_image is None:
+                        palette_image = Image.fromarray(
+                            np.concatenate([image_rgb, overlaid]), 'RGB'
+                        ).quantize()
+                    pair_frames = tuple(
+                        frame.quantize(palette=palette_image, dither=Image.Dither.NONE)
+                        for frame in pair_frames
+                    )
+                
+                yield from pair_frames
         
-        print(f"GIF successfully created: {output_path}")
-        print(f"  Total frames: {len(frames)}")
+        # Frames are produced lazily. The GIF writer consumes them as they
+        # come and keeps only palettized copies; Pillow's WebP writer lists
+        # append_images first, so WebP output holds every RGB frame at once.
+        frames = _iter_frames()
+        first = next(frames)
+        print(f"Saving {output_format.upper()} to {output_path}...")
+        save_kwargs = {
+            'save_all': True,
+            'append_images': frames,
+            'duration': durations,
+            'loop': self.loop
+        }
+        # Encode into RAM so encoder throughput doesn't wait on the disk
+        target = io.BytesIO() if buffer_output else output_path
+        if output_format == 'webp':
+            first.save(target, format='WEBP', lossless=False, quality=80, **save_kwargs)
+        else:
+            first.save(target, format='GIF', optimize=False, **save_kwargs)
+        
+        if buffer_output:
+            with open(output_path, 'wb') as f:
+                f.write(target.getbuffer())
+        
+        print(f"{output_format.upper()} successfully created: {output_path}")
+        print(f"  Total frames: {len(durations)}")
         print(f"  Total duration: {sum(durations)/1000:.2f} seconds")
 
 
+def _init_worker():
+    """Pin Numba to one thread per worker so the pool doesn't oversubscribe."""
+    if numba is not None:
+        numba.set_num_threads(1)
+
+
+def _load_decoded(loader: Callable[[Any], Any], source: Any) -> Any:
+    """Run a load_* method and force PIL's lazy decode on the calling thread."""
+    loaded = loader(source)
+    if isinstance(loaded, Image.Image):
+        loaded.load()
+    return loaded
+
+
+def _resize_image(image: Image.Image, size: Tuple[int, int]) -> np.ndarray:
+    """Lanczos resize to an RGB uint8 array."""
+    # cv2's INTER_LANCZOS4 (and INTER_AREA's box filter) alias badly when
+    # shrinking, where PIL's LANCZOS widens its kernel; only upscales use cv2
+    width, height = image.size
+    if cv2 is not None and size[0] >= width and size[1] >= height:
+        return cv2.resize(
+            np.asarray(image.convert('RGB')), size, interpolation=cv2.INTER_LANCZOS4
+        )
+    return np.asarray(image.resize(size, Image.Resampling.LANCZOS).convert('RGB'))
+
+
+def _resize_mask(
+    mask: Union[np.ndarray, Image.Image],
+    size: Tuple[int, int]
+) -> np.ndarray:
+    """Nearest-neighbour resize to a uint8 array."""
+    if cv2 is not None:
+        # INTER_NEAREST_EXACT picks the same source pixels as PIL's NEAREST
+        return cv2.resize(
+            _as_uint8_mask(mask), size, interpolation=cv2.INTER_NEAREST_EXACT
+        )
+    
+    if not isinstance(mask, Image.Image):
+        mask = Image.fromarray(_as_uint8_mask(mask))
+    return _as_uint8_mask(mask.resize(size, Image.Resampling.NEAREST))
+
+
+def _process_pair(
+    generator: MultiClassSegmentationGifGenerator,
+    img_path: Union[str, Image.Image],
+    mask_path: Union[str, np.ndarray, Image.Image],
+    resize: Optional[Tuple[int, int]]
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Load, resize and overlay one image-mask pair (picklable worker entry)."""
+    image = generator.load_image(img_path)
+    mask = generator.load_mask(mask_path)
+    
+    # Convert once; the same RGB array feeds the plain frame and the blend
+    if resize is not None:
+        image_rgb = _resize_image(image, resize)
+        mask = _resize_mask(mask, resize)
+    else:
+        image_rgb = np.asarray(image.convert('RGB'))
+        mask = _as_uint8_mask(mask)
+    
+    overlaid = generator.create_multiclass_overlay(image_rgb, mask)
+    return image_rgb, overlaid
+
+
 def create_multiclass_segmentation_gif(
     images: List[Union[str, Image.Image]],
-    masks: List[Union[str, np.ndarray]],
+    masks: List[Union[str, np.ndarray, Image.Image]],
     output_path: str,
     image_duration: int = 500,
     mask_duration: int = 1000,
     class_colors: Optional[Dict[int, Tuple[int, int, int]]] = None,
     mask_alpha: float = 0.5,
     resize: Optional[Tuple[int, int]] = None,
-    loop: int = 0
+    loop: int = 0,
+    max_workers: Optional[int] = 1,
+    output_format: str = 'gif',
+    match_mode: str = 'tolerance',
+    buffer_output: bool = True,
+    shared_palette: bool = False
 ):
     """
     Create a multi-class segmentation GIF.
     
     Args:
         images: List of image paths or PIL Images
-        masks: List of 2D mask paths or numpy arrays
+        masks: List of 2D mask paths, numpy arrays or PIL Images
         output_path: Output GIF file path
         image_duration: Duration to show image alone (ms)
         mask_duration: Duration to show overlay (ms)
@@ -178,16 +523,33 @@ def create_multiclass_segmentation_gif(
         mask_alpha: Overlay transparency (0.0 to 1.0)
         resize: Optional (width, height) to resize frames
         loop: Loop count (0 = infinite)
+        max_workers: Worker processes for frame production
+            (1 = serial, None = CPU count)
+        output_format: 'gif' or 'webp'
+        match_mode: 'tolerance' (class value +/- 10) or 'exact'
+        buffer_output: Encode in memory and write once (False = stream to disk)
+        shared_palette: Quantize all GIF frames to the first pair's palette
+            (faster; only suited to sequences whose frames look alike)
     """
     generator = MultiClassSegmentationGifGenerator(
         image_duration=image_duration,
         mask_duration=mask_duration,
         class_colors=class_colors,
         mask_alpha=mask_alpha,
-        loop=loop
+        loop=loop,
+        match_mode=match_mode
     )
     
-    generator.generate_gif(images, masks, output_path, resize=resize)
+    generator.generate_gif(
+        images,
+        masks,
+        output_path,
+        resize=resize,
+        max_workers=max_workers,
+        output_format=output_format,
+        buffer_output=buffer_output,
+        shared_palette=shared_palette
+    )
 
 
 if __name__ == "__main__":